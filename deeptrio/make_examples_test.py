@@ -30,9 +30,12 @@
 
 import copy
 import errno
+import functools
 import json
 import platform
+import re
 import sys
+import types
 from unittest import mock
 
 
@@ -41,11 +44,14 @@ from absl import logging
 from absl.testing import absltest
 from absl.testing import flagsaver
 from absl.testing import parameterized
+import numpy as np
 import six
+import tensorflow as tf
 
 from deeptrio import make_examples
 from deeptrio import testdata
 from deepvariant import make_examples_core
+from deepvariant import make_examples_options
 from deepvariant import tf_utils
 from deepvariant.labeler import variant_labeler
 from deepvariant.protos import deepvariant_pb2
@@ -63,39 +69,136 @@ from third_party.nucleus.util import vcf_constants
 
 FLAGS = flags.FLAGS
 
-# Dictionary mapping keys to decoders for decode_example function.
-_EXAMPLE_DECODERS = {
-    'locus': tf_utils.example_locus,
-    'alt_allele_indices/encoded': tf_utils.example_alt_alleles_indices,
-    'image/encoded': tf_utils.example_encoded_image,
-    'variant/encoded': tf_utils.example_variant,
-    'variant_type': tf_utils.example_variant_type,
-    'label': tf_utils.example_label,
-    'image/shape': tf_utils.example_image_shape,
-    'sequencing_type': tf_utils.example_sequencing_type,
+# Maps each DeepVariant tf.Example feature key to the spec used to parse it
+# and the decoder applied to the parsed value. Optional features get a default
+# value so a single spec covers calling and training examples;
+# decode_examples_batch only keeps keys that are present.
+_EXAMPLE_FEATURE_DECODERS = {
+    'locus': (tf.io.FixedLenFeature([], tf.string, default_value=''), bytes),
+    'alt_allele_indices/encoded':
+        (tf.io.FixedLenFeature([], tf.string, default_value=''),
+         lambda value: list(deepvariant_pb2.CallVariantsOutput.AltAlleleIndices
+                            .FromString(value).indices)),
+    'image/encoded':
+        (tf.io.FixedLenFeature([], tf.string, default_value=''), bytes),
+    'variant/encoded': (tf.io.FixedLenFeature([], tf.string, default_value=''),
+                        variants_pb2.Variant.FromString),
+    'variant_type':
+        (tf.io.FixedLenFeature([], tf.int64, default_value=-1), int),
+    'label': (tf.io.FixedLenFeature([], tf.int64, default_value=-1), int),
+    'image/shape':
+        (tf.io.FixedLenFeature([3], tf.int64, default_value=[-1, -1, -1]),
+         lambda value: [int(dim) for dim in value]),
+    'sequencing_type':
+        (tf.io.FixedLenFeature([], tf.int64, default_value=-1), int),
 }
 
+# Feature spec for parsing serialized DeepVariant tf.Examples in one batch.
+_EXAMPLE_FEATURES = {
+    key: spec for key, (spec, _) in _EXAMPLE_FEATURE_DECODERS.items()
+}
+
+
+def decode_examples_batch(examples):
+  """Decodes tf.Examples from DeepVariant with a single tf.io.parse_example.
 
-def decode_example(example):
-  """Decodes a tf.Example from DeepVariant into a dict of Pythonic structures.
+  All examples are parsed in one vectorized call, and each value is then
+  decoded into Python structures like protos, lists, etc.
 
   Args:
-    example: tf.Example proto. The example to make into a dictionary.
+    examples: list of tf.Example protos to decode.
 
   Returns:
-    A python dictionary with key/value pairs for each of the fields of example,
-    with each value decoded as needed into Python structures like protos, list,
-    etc.
+    A list of python dictionaries, one per example, with key/value pairs for
+    each of the fields of that example.
 
   Raises:
-    KeyError: If example contains a feature without a known decoder.
+    KeyError: If an example contains a feature without a known decoder.
+  """
+  if not examples:
+    return []
+  parsed = tf.io.parse_example(
+      [example.SerializeToString() for example in examples],
+      _EXAMPLE_FEATURES)
+  parsed = {key: tensor.numpy() for key, tensor in parsed.items()}
+  decoded = []
+  for i, example in enumerate(examples):
+    as_dict = {}
+    for key in example.features.feature:
+      if key not in _EXAMPLE_FEATURE_DECODERS:
+        raise KeyError('Unexpected example key', key)
+      _, decoder = _EXAMPLE_FEATURE_DECODERS[key]
+      as_dict[key] = decoder(parsed[key][i])
+    decoded.append(as_dict)
+  return decoded
+
+
+@functools.lru_cache(maxsize=None)
+def _load_golden(path):
+  """Reads and decodes the golden tf.Examples in path, once per process.
+
+  Args:
+    path: str. Path to a (possibly sharded) golden tfrecord of tf.Examples.
+
+  Returns:
+    A tuple of dictionaries, as returned by decode_examples_batch, one for each
+    example in path. Callers must not modify the returned dictionaries.
   """
-  as_dict = {}
-  for key in example.features.feature:
-    if key not in _EXAMPLE_DECODERS:
-      raise KeyError('Unexpected example key', key)
-    as_dict[key] = _EXAMPLE_DECODERS[key](example)
-  return as_dict
+  return tuple(decode_examples_batch(list(tfrecord.read_tfrecords(path))))
+
+
+def _trio_flags(mode, **overrides):
+  """Returns flag values for a trio make_examples run, for unit tests.
+
+  Args:
+    mode: str. 'calling' or 'training'. Training also sets the truth variants
+      and confident regions.
+    **overrides: Flag values to use instead of the defaults here.
+
+  Returns:
+    A dict of flag values, for make_examples_options.default_options_from_dict.
+  """
+  flag_values = {
+      'mode': mode,
+      'ref': testdata.CHR20_FASTA,
+      'reads': testdata.HG001_CHR20_BAM,
+      'reads_parent1': testdata.NA12891_CHR20_BAM,
+      'reads_parent2': testdata.NA12892_CHR20_BAM,
+      'sample_name': 'child',
+      'sample_name_to_train': 'child',
+      'sample_name_parent1': 'parent1',
+      'sample_name_parent2': 'parent2',
+      'examples': 'examples.tfrecord',
+  }
+  if mode == 'training':
+    flag_values.update(
+        truth_variants=testdata.TRUTH_VARIANTS_VCF,
+        confident_regions=testdata.CONFIDENT_REGIONS_BED,
+        examples='')
+  flag_values.update(overrides)
+  return flag_values
+
+
+# Error messages checked by the RegionProcessorTest and option tests.
+_REF_MISMATCH_RE = re.compile('does not match the bases in the reference')
+_PILEUP_HEIGHT_RE = re.compile(
+    r'Pileup image heights must be between 10 and 100\.')
+
+# Calling regions used by the end-to-end tests, parsed once at import.
+_REGION_10M_10K = ranges.parse_literal('20:10,000,000-10,010,000')
+_REGION_10M_10K_LITERAL = ranges.to_literal(_REGION_10M_10K)
+_REGION_10M_4K = ranges.parse_literal('20:10,000,000-10,004,000')
+_REGION_10M_4K_LITERAL = ranges.to_literal(_REGION_10M_4K)
+
+
+@functools.lru_cache(maxsize=None)
+def _truth_variants(region_literal):
+  """Returns the truth variants in region_literal, read once per process.
+
+  Callers must copy a variant before modifying it.
+  """
+  with vcf.VcfReader(testdata.TRUTH_VARIANTS_VCF) as reader:
+    return tuple(reader.query(ranges.parse_literal(region_literal)))
 
 
 def setUpModule():
@@ -137,6 +240,39 @@ def _from_literals(literals, contig_map=None):
   return ranges.RangeSet.from_regions(literals, contig_map)
 
 
+def _variant_site_key(variant):
+  return (variant.reference_bases, variant.start, variant.end)
+
+
+def _variant_key(variant):
+  return (variant.reference_name, variant.start, variant.end,
+          variant.reference_bases, tuple(variant.alternate_bases))
+
+
+def _variant_arrays(variants):
+  """Extracts the fields checked by verify_variants into numpy arrays.
+
+  Args:
+    variants: list of Variant protos.
+
+  Returns:
+    A dict mapping field names to numpy arrays with one element per variant.
+  """
+  return {
+      'reference_name':
+          np.asarray([v.reference_name for v in variants], dtype=object),
+      'start': np.asarray([v.start for v in variants], dtype=np.int64),
+      'end': np.asarray([v.end for v in variants], dtype=np.int64),
+      'reference_bases_len':
+          np.asarray([len(v.reference_bases) for v in variants],
+                     dtype=np.int64),
+      'alternate_bases_len':
+          np.asarray([len(v.alternate_bases) for v in variants],
+                     dtype=np.int64),
+      'calls_len': np.asarray([len(v.calls) for v in variants], dtype=np.int64),
+  }
+
+
 def _sharded(basename, num_shards=None):
   if num_shards:
     return basename + '@' + str(num_shards)
@@ -170,7 +306,7 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
                                  labeler_algorithm=None,
                                  use_fast_pass_aligner=True):
     self.assertIn(mode, {'calling', 'training'})
-    region = ranges.parse_literal('20:10,000,000-10,010,000')
+    region = _REGION_10M_10K
     FLAGS.write_run_info = True
     FLAGS.ref = testdata.CHR20_FASTA
     FLAGS.reads = testdata.HG001_CHR20_BAM
@@ -186,7 +322,7 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
         _sharded('examples.tfrecord', num_shards))
     child_examples = test_utils.test_tmpfile(
         _sharded('examples_child.tfrecord', num_shards))
-    FLAGS.regions = [ranges.to_literal(region)]
+    FLAGS.regions = [_REGION_10M_10K_LITERAL]
     FLAGS.partition_size = 1000
     FLAGS.mode = mode
     FLAGS.gvcf_gq_binsize = 5
@@ -207,6 +343,7 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
       child_candidates = test_utils.test_tmpfile(
           _sharded('vsc.tfrecord', num_shards))
 
+    expected_host = platform.node()
     for task_id in range(max(num_shards, 1)):
       FLAGS.task = task_id
       options = make_examples.default_options(add_flags=True)
@@ -219,7 +356,7 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
       self.assertEqual(run_info.options, options)
       # (b) run_info.resource_metrics is present and contains our hostname.
       self.assertTrue(run_info.HasField('resource_metrics'))
-      self.assertEqual(run_info.resource_metrics.host_name, platform.node())
+      self.assertEqual(run_info.resource_metrics.host_name, expected_host)
 
     # Test that our candidates are reasonable, calling specific helper functions
     # to check lots of properties of the output.
@@ -228,24 +365,29 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
             child_candidates, proto=deepvariant_pb2.DeepVariantCall),
         key=lambda c: variant_utils.variant_range_tuple(c.variant))
     self.verify_deepvariant_calls(candidates, options)
-    self.verify_variants([call.variant for call in candidates],
-                         region,
-                         options,
-                         is_gvcf=False)
+    candidate_keys = self.verify_variants(
+        [call.variant for call in candidates], region, options, is_gvcf=False)
 
     # Verify that the variants in the examples are all good.
     if mode == 'calling':
-      examples = self.verify_examples(
+      _, decoded_examples = self.verify_examples(
           child_examples,
           region,
           options,
           verify_labels=False,
           examples_filename=FLAGS.examples)
     else:
-      examples = self.verify_examples(
+      _, decoded_examples = self.verify_examples(
           FLAGS.examples, region, options, verify_labels=True)
-    example_variants = [tf_utils.example_variant(ex) for ex in examples]
-    self.verify_variants(example_variants, region, options, is_gvcf=False)
+    example_variants = [
+        decoded['variant/encoded'] for decoded in decoded_examples
+    ]
+    # Examples are made from the candidates verified above, so it's enough to
+    # check that each example variant is one of them.
+    example_keys = {_variant_key(v) for v in example_variants}
+    self.assertEmpty(
+        sorted(example_keys - candidate_keys),
+        msg='Example variants missing from the verified candidates.')
 
     # Verify the integrity of the examples and then check that they match our
     # golden labeled examples. Note we expect the order for both training and
@@ -255,12 +397,11 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
       golden_file = _sharded(testdata.GOLDEN_CALLING_EXAMPLES, num_shards)
     else:
       golden_file = _sharded(testdata.GOLDEN_TRAINING_EXAMPLES, num_shards)
-    self.assertDeepVariantExamplesEqual(
-        examples, list(tfrecord.read_tfrecords(golden_file)))
+    self.assertDeepVariantExamplesEqual(decoded_examples,
+                                        _load_golden(golden_file))
 
     if mode == 'calling':
-      nist_reader = vcf.VcfReader(testdata.TRUTH_VARIANTS_VCF)
-      nist_variants = list(nist_reader.query(region))
+      nist_variants = _truth_variants(_REGION_10M_10K_LITERAL)
       self.verify_nist_concordance(example_variants, nist_variants)
 
       # Check the quality of our generated gvcf file.
@@ -270,10 +411,14 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
       self.verify_contiguity(gvcfs, region)
       gvcf_golden_file = _sharded(testdata.GOLDEN_POSTPROCESS_GVCF_INPUT,
                                   num_shards)
-      expected_gvcfs = list(
-          tfrecord.read_tfrecords(gvcf_golden_file, proto=variants_pb2.Variant))
+      expected_gvcfs = tfrecord.read_tfrecords(
+          gvcf_golden_file, proto=variants_pb2.Variant)
       # Despite its name, assertCountEqual checks that all items are equal.
-      self.assertCountEqual(gvcfs, expected_gvcfs)
+      # Records are compared as deterministically serialized bytes: unlike
+      # protos these are hashable, so the comparison isn't quadratic.
+      self.assertCountEqual(
+          [v.SerializeToString(deterministic=True) for v in gvcfs],
+          [v.SerializeToString(deterministic=True) for v in expected_gvcfs])
 
     if (mode == 'training' and num_shards == 0 and
         labeler_algorithm != 'positional_labeler'):
@@ -290,8 +435,8 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
     FLAGS.labeler_algorithm = 'customized_classes_labeler'
     FLAGS.customized_classes_labeler_classes_list = 'ref,class1,class2'
     FLAGS.customized_classes_labeler_info_field_name = 'type'
-    region = ranges.parse_literal('20:10,000,000-10,004,000')
-    FLAGS.regions = [ranges.to_literal(region)]
+    region = _REGION_10M_4K
+    FLAGS.regions = [_REGION_10M_4K_LITERAL]
     FLAGS.ref = testdata.CHR20_FASTA
     FLAGS.reads = testdata.HG001_CHR20_BAM
     FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
@@ -311,16 +456,16 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
     make_examples_core.make_examples_runner(options)
     golden_file = _sharded(testdata.CUSTOMIZED_CLASSES_GOLDEN_TRAINING_EXAMPLES)
     # Verify that the variants in the examples are all good.
-    examples = self.verify_examples(
+    _, decoded_examples = self.verify_examples(
         FLAGS.examples, region, options, verify_labels=True)
-    self.assertDeepVariantExamplesEqual(
-        examples, list(tfrecord.read_tfrecords(golden_file)))
+    self.assertDeepVariantExamplesEqual(decoded_examples,
+                                        _load_golden(golden_file))
 
   # Golden sets are created with learning/genomics/internal/create_golden.sh
   @flagsaver.flagsaver
   def test_make_examples_training_end2end_with_alt_aligned_pileup(self):
-    region = ranges.parse_literal('20:10,000,000-10,010,000')
-    FLAGS.regions = [ranges.to_literal(region)]
+    region = _REGION_10M_10K
+    FLAGS.regions = [_REGION_10M_10K_LITERAL]
     FLAGS.ref = testdata.CHR20_FASTA
     FLAGS.reads = testdata.HG001_CHR20_BAM
     FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
@@ -347,13 +492,13 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
     make_examples_core.make_examples_runner(options)
     golden_file = _sharded(testdata.ALT_ALIGNED_PILEUP_GOLDEN_TRAINING_EXAMPLES)
     # Verify that the variants in the examples are all good.
-    examples = self.verify_examples(
+    _, decoded_examples = self.verify_examples(
         FLAGS.examples, region, options, verify_labels=True)
-    self.assertDeepVariantExamplesEqual(
-        examples, list(tfrecord.read_tfrecords(golden_file)))
+    self.assertDeepVariantExamplesEqual(decoded_examples,
+                                        _load_golden(golden_file))
     # Pileup image should now have 8 channels.
     # Height should be 60 + 40 * 2 = 140.
-    self.assertEqual(decode_example(examples[0])['image/shape'], [140, 199, 8])
+    self.assertEqual(decoded_examples[0]['image/shape'], [140, 199, 8])
 
   @parameterized.parameters(
       dict(select_types=None, expected_count=79),
@@ -382,8 +527,7 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
                                                 keep_legacy_behavior=False):
     if select_types is not None:
       FLAGS.select_variant_types = select_types
-    region = ranges.parse_literal('20:10,000,000-10,010,000')
-    FLAGS.regions = [ranges.to_literal(region)]
+    FLAGS.regions = [_REGION_10M_10K_LITERAL]
     FLAGS.ref = testdata.CHR20_FASTA
     FLAGS.reads = testdata.HG001_CHR20_BAM
     FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
@@ -402,8 +546,8 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
     options = make_examples.default_options(add_flags=True)
     make_examples_core.make_examples_runner(options)
 
-    candidates = list(tfrecord.read_tfrecords(child_candidates))
-    self.assertLen(candidates, expected_count)
+    n_candidates = sum(1 for _ in tfrecord.read_tfrecords(child_candidates))
+    self.assertEqual(n_candidates, expected_count)
 
   @parameterized.parameters(
       dict(
@@ -430,8 +574,7 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
   @flagsaver.flagsaver
   def test_make_examples_training_end2end_duos(self, mode, which_parent,
                                                sample_name_to_train):
-    region = ranges.parse_literal('20:10,000,000-10,010,000')
-    FLAGS.regions = [ranges.to_literal(region)]
+    FLAGS.regions = [_REGION_10M_10K_LITERAL]
     FLAGS.ref = testdata.CHR20_FASTA
     FLAGS.reads = testdata.HG001_CHR20_BAM
     FLAGS.sample_name = 'child'
@@ -500,14 +643,14 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
     options = make_examples.default_options(add_flags=True)
     make_examples_core.make_examples_runner(options)
     # Verify that the variants in the examples are all good.
-    output_examples_to_compare = self.verify_examples(
+    _, output_examples_to_compare = self.verify_examples(
         path_to_output_examples,
         None,
         options,
         verify_labels=mode == 'training',
         examples_filename=FLAGS.examples)
-    self.assertDeepVariantExamplesEqual(
-        output_examples_to_compare, list(tfrecord.read_tfrecords(golden_file)))
+    self.assertDeepVariantExamplesEqual(output_examples_to_compare,
+                                        _load_golden(golden_file))
 
   def verify_nist_concordance(self, candidates, nist_variants):
     # Tests that we call almost all of the real variants (according to NIST's
@@ -516,9 +659,13 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
     # no more than 5x (arbitrary) more candidate calls than real calls. If we
     # have more it's likely due to some major pipeline problem.
     self.assertLess(len(candidates), 5 * len(nist_variants))
+    candidates_index = {}
+    for candidate in candidates:
+      candidates_index.setdefault(_variant_site_key(candidate),
+                                  set()).update(candidate.alternate_bases)
     tp_count = 0
     for nist_variant in nist_variants:
-      if self.assertVariantIsPresent(nist_variant, candidates):
+      if self.assertVariantIsPresent(nist_variant, candidates_index):
         tp_count = tp_count + 1
 
     self.assertGreater(
@@ -530,60 +677,95 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
     """Asserts that actual and expected tf.Examples from DeepVariant are equal.
 
     Args:
-      actual: iterable of tf.Examples from DeepVariant. DeepVariant examples
-        that we want to check.
-      expected: iterable of tf.Examples. Expected results for actual.
+      actual: sequence of decoded DeepVariant examples that we want to check, as
+        returned by verify_examples.
+      expected: sequence of decoded examples, as returned by _load_golden.
+        Expected results for actual.
     """
+    actual = list(actual)
+    expected = list(expected)
     self.assertEqual(len(actual), len(expected))
-    for i in range(len(actual)):
-      self.assertEqual(decode_example(actual[i]), decode_example(expected[i]))
+    # Compare one example at a time so a mismatch doesn't diff every encoded
+    # image in the file.
+    for i, (actual_example, expected_example) in enumerate(
+        zip(actual, expected)):
+      self.assertEqual(
+          actual_example, expected_example, msg='Example {}'.format(i))
 
-  def assertVariantIsPresent(self, to_find, variants):
+  def assertVariantIsPresent(self, to_find, variants_index):
+    """Returns True if to_find is among the indexed variants.
 
-    def variant_key(v):
-      return (v.reference_bases, v.start, v.end)
+    Args:
+      to_find: Variant proto to look for.
+      variants_index: dict mapping _variant_site_key() of each variant in our
+        actual call set to the set of its alternate bases.
 
-    # Finds a call in our actual call set for each NIST variant, asserting
-    # that we found exactly one.
-    matches = [
-        variant for variant in variants
-        if variant_key(to_find) == variant_key(variant)
-    ]
-    if not matches:
+    Returns:
+      True if a variant at the same site as to_find is present and every alt
+      allele of to_find appears in it (the call might have more alts).
+    """
+    alts = variants_index.get(_variant_site_key(to_find))
+    if alts is None:
       return False
+    return alts.issuperset(to_find.alternate_bases)
 
-    # Verify that every alt allele appears in the call (but the call might)
-    # have more than just those calls.
-    for alt in to_find.alternate_bases:
-      if alt not in matches[0].alternate_bases:
-        return False
+  def _assert_all_variants(self, mask, values, description):
+    """Asserts that mask holds for every variant.
 
-    return True
+    Args:
+      mask: numpy bool array with one element per variant.
+      values: numpy array of the checked values, parallel to mask.
+      description: str. The condition being checked, used in the message.
+    """
+    failed = np.flatnonzero(~mask)
+    self.assertEmpty(
+        failed.tolist(),
+        msg='{} does not hold for variants at indices {}, values {}'.format(
+            description, failed.tolist(), values[failed].tolist()))
 
   def verify_variants(self, variants, region, options, is_gvcf):
     # Verifies simple properties of the Variant protos in variants. For example,
     # checks that the reference_name() is our expected chromosome. The flag
     # is_gvcf determines how we check the VariantCall field of each variant,
     # enforcing expectations for gVCF records if true or variant calls if false.
-    for variant in variants:
-      if region:
-        self.assertEqual(variant.reference_name, region.reference_name)
-        self.assertGreaterEqual(variant.start, region.start)
-        self.assertLessEqual(variant.start, region.end)
-      self.assertNotEqual(variant.reference_bases, '')
-      self.assertNotEmpty(variant.alternate_bases)
-      self.assertLen(variant.calls, 1)
-
-      call = variant_utils.only_call(variant)
-      self.assertEqual(
-          call.call_set_name,
-          options.sample_options[1].variant_caller_options.sample_name)
-      if is_gvcf:
+    # Per-variant scalar fields are checked as whole arrays. variants may be any
+    # iterable. Returns a frozenset of the _variant_key() of every verified
+    # variant.
+    variants = list(variants)
+    arrays = _variant_arrays(variants)
+    if region:
+      self._assert_all_variants(
+          arrays['reference_name'] == region.reference_name,
+          arrays['reference_name'],
+          'reference_name == {}'.format(region.reference_name))
+      self._assert_all_variants(arrays['start'] >= region.start,
+                                arrays['start'],
+                                'start >= {}'.format(region.start))
+      self._assert_all_variants(arrays['start'] <= region.end, arrays['start'],
+                                'start <= {}'.format(region.end))
+    self._assert_all_variants(arrays['reference_bases_len'] > 0,
+                              arrays['reference_bases_len'],
+                              'len(reference_bases) > 0')
+    self._assert_all_variants(arrays['alternate_bases_len'] > 0,
+                              arrays['alternate_bases_len'],
+                              'len(alternate_bases) > 0')
+    self._assert_all_variants(arrays['calls_len'] == 1, arrays['calls_len'],
+                              'len(calls) == 1')
+
+    calls = [variant.calls[0] for variant in variants]
+    sample_name = options.sample_options[1].variant_caller_options.sample_name
+    call_set_names = np.asarray([call.call_set_name for call in calls],
+                                dtype=object)
+    self._assert_all_variants(call_set_names == sample_name, call_set_names,
+                              'call_set_name == {}'.format(sample_name))
+    if is_gvcf:
+      for call in calls:
         # GVCF records should have 0/0 or ./. (un-called) genotypes as they are
         # reference sites, have genotype likelihoods and a GQ value.
         self.assertIn(list(call.genotype), [[0, 0], [-1, -1]])
         self.assertLen(call.genotype_likelihood, 3)
         self.assertGreaterEqual(variantcall_utils.get_gq(call), 0)
+    return frozenset(_variant_key(variant) for variant in variants)
 
   def verify_contiguity(self, contiguous_variants, region):
     """Verifies region is fully covered by gvcf records."""
@@ -613,7 +795,8 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
   def verify_deepvariant_calls(self, dv_calls, options):
     # Verifies simple structural properties of the DeepVariantCall objects
     # emitted by the VerySensitiveCaller, such as that the AlleleCount and
-    # Variant both have the same position.
+    # Variant both have the same position. dv_calls can be any iterable; it is
+    # consumed in a single pass.
     for call in dv_calls:
       for alt_allele in call.variant.alternate_bases:
         # Skip ref calls.
@@ -644,7 +827,9 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
                       options,
                       verify_labels,
                       examples_filename=None):
-    # Do some simple structural checks on the tf.Examples in the file.
+    # Do some simple structural checks on the tf.Examples in the file. Returns
+    # the examples along with their decode_examples_batch dictionaries, so
+    # callers don't need to parse them again.
     expected_features = [
         'variant/encoded', 'locus', 'image/encoded',
         'alt_allele_indices/encoded'
@@ -653,14 +838,16 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
       expected_features += ['label']
 
     examples = list(tfrecord.read_tfrecords(path_to_output_examples))
-    for example in examples:
+    # Each example's variant and alt allele indices are parsed only once, here.
+    decoded_examples = decode_examples_batch(examples)
+    for decoded in decoded_examples:
       for label_feature in expected_features:
-        self.assertIn(label_feature, example.features.feature)
+        self.assertIn(label_feature, decoded)
       # pylint: disable=g-explicit-length-test
-      self.assertNotEmpty(tf_utils.example_alt_alleles_indices(example))
+      self.assertNotEmpty(decoded['alt_allele_indices/encoded'])
 
     # Check that the variants in the examples are good.
-    variants = [tf_utils.example_variant(x) for x in examples]
+    variants = [decoded['variant/encoded'] for decoded in decoded_examples]
     self.verify_variants(variants, region, options, is_gvcf=False)
 
     # In DeepTrio, path_to_output_examples can be pointing to the ones with
@@ -672,11 +859,23 @@ class MakeExamplesEnd2EndTest(parameterized.TestCase):
         examples_filename = path_to_output_examples
       self.sanity_check_example_info_json(examples[0], examples_filename,
                                           options.task_id)
-    return examples
+    return examples, decoded_examples
 
 
 class MakeExamplesUnitTest(parameterized.TestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    super(MakeExamplesUnitTest, cls).setUpClass()
+    cls._base_options = make_examples_options.default_options_from_dict(
+        make_examples.default_options, _trio_flags('training'))
+
+  def _clone_base_options(self):
+    """Returns a copy of the options made from _trio_flags('training')."""
+    options = deepvariant_pb2.MakeExamplesOptions()
+    options.CopyFrom(self._base_options)
+    return options
+
   def test_read_write_run_info(self):
 
     def _read_lines(path):
@@ -702,138 +901,51 @@ class MakeExamplesUnitTest(parameterized.TestCase):
         _read_lines(testdata.GOLDEN_MAKE_EXAMPLES_RUN_INFO),
         _read_lines(tmp_output))
 
-  @flagsaver.flagsaver
   def test_keep_duplicates(self):
-    FLAGS.keep_duplicates = True
-    FLAGS.ref = testdata.CHR20_FASTA
-    FLAGS.reads = testdata.HG001_CHR20_BAM
-    FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
-    FLAGS.reads_parent2 = testdata.NA12892_CHR20_BAM
-    FLAGS.sample_name = 'child'
-    FLAGS.sample_name_to_train = 'child'
-    FLAGS.sample_name_parent1 = 'parent1'
-    FLAGS.sample_name_parent2 = 'parent2'
-    FLAGS.truth_variants = testdata.TRUTH_VARIANTS_VCF
-    FLAGS.confident_regions = testdata.CONFIDENT_REGIONS_BED
-    FLAGS.mode = 'training'
-    FLAGS.examples = ''
-    options = make_examples.default_options(add_flags=True)
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options,
+        _trio_flags('training', keep_duplicates=True))
     self.assertEqual(options.pic_options.read_requirements.keep_duplicates,
                      True)
 
-  @flagsaver.flagsaver
   def test_keep_supplementary_alignments(self):
-    FLAGS.keep_supplementary_alignments = True
-    FLAGS.ref = testdata.CHR20_FASTA
-    FLAGS.reads = testdata.HG001_CHR20_BAM
-    FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
-    FLAGS.reads_parent2 = testdata.NA12892_CHR20_BAM
-    FLAGS.sample_name = 'child'
-    FLAGS.sample_name_to_train = 'child'
-    FLAGS.sample_name_parent1 = 'parent1'
-    FLAGS.sample_name_parent2 = 'parent2'
-    FLAGS.truth_variants = testdata.TRUTH_VARIANTS_VCF
-    FLAGS.confident_regions = testdata.CONFIDENT_REGIONS_BED
-    FLAGS.mode = 'training'
-    FLAGS.examples = ''
-    options = make_examples.default_options(add_flags=True)
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options,
+        _trio_flags('training', keep_supplementary_alignments=True))
     self.assertEqual(
         options.pic_options.read_requirements.keep_supplementary_alignments,
         True)
 
-  @flagsaver.flagsaver
   def test_keep_secondary_alignments(self):
-    FLAGS.keep_secondary_alignments = True
-    FLAGS.ref = testdata.CHR20_FASTA
-    FLAGS.reads = testdata.HG001_CHR20_BAM
-    FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
-    FLAGS.reads_parent2 = testdata.NA12892_CHR20_BAM
-    FLAGS.sample_name = 'child'
-    FLAGS.sample_name_to_train = 'child'
-    FLAGS.sample_name_parent1 = 'parent1'
-    FLAGS.sample_name_parent2 = 'parent2'
-    FLAGS.truth_variants = testdata.TRUTH_VARIANTS_VCF
-    FLAGS.confident_regions = testdata.CONFIDENT_REGIONS_BED
-    FLAGS.mode = 'training'
-    FLAGS.examples = ''
-    options = make_examples.default_options(add_flags=True)
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options,
+        _trio_flags('training', keep_secondary_alignments=True))
     self.assertEqual(
         options.pic_options.read_requirements.keep_secondary_alignments, True)
 
-  @flagsaver.flagsaver
   def test_min_base_quality(self):
-    FLAGS.min_base_quality = 5
-    FLAGS.ref = testdata.CHR20_FASTA
-    FLAGS.reads = testdata.HG001_CHR20_BAM
-    FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
-    FLAGS.reads_parent2 = testdata.NA12892_CHR20_BAM
-    FLAGS.sample_name = 'child'
-    FLAGS.sample_name_to_train = 'child'
-    FLAGS.sample_name_parent1 = 'parent1'
-    FLAGS.sample_name_parent2 = 'parent2'
-    FLAGS.truth_variants = testdata.TRUTH_VARIANTS_VCF
-    FLAGS.confident_regions = testdata.CONFIDENT_REGIONS_BED
-    FLAGS.mode = 'training'
-    FLAGS.examples = ''
-    options = make_examples.default_options(add_flags=True)
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options,
+        _trio_flags('training', min_base_quality=5))
     self.assertEqual(options.pic_options.read_requirements.min_base_quality, 5)
 
-  @flagsaver.flagsaver
   def test_min_mapping_quality(self):
-    FLAGS.min_mapping_quality = 15
-    FLAGS.ref = testdata.CHR20_FASTA
-    FLAGS.reads = testdata.HG001_CHR20_BAM
-    FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
-    FLAGS.reads_parent2 = testdata.NA12892_CHR20_BAM
-    FLAGS.sample_name = 'child'
-    FLAGS.sample_name_to_train = 'child'
-    FLAGS.sample_name_parent1 = 'parent1'
-    FLAGS.sample_name_parent2 = 'parent2'
-    FLAGS.truth_variants = testdata.TRUTH_VARIANTS_VCF
-    FLAGS.confident_regions = testdata.CONFIDENT_REGIONS_BED
-    FLAGS.mode = 'training'
-    FLAGS.examples = ''
-    options = make_examples.default_options(add_flags=True)
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options,
+        _trio_flags('training', min_mapping_quality=15))
     self.assertEqual(options.pic_options.read_requirements.min_mapping_quality,
                      15)
 
-  @flagsaver.flagsaver
   def test_default_options_with_training_random_emit_ref_sites(self):
-    FLAGS.ref = testdata.CHR20_FASTA
-    FLAGS.reads = testdata.HG001_CHR20_BAM
-    FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
-    FLAGS.reads_parent2 = testdata.NA12892_CHR20_BAM
-    FLAGS.sample_name = 'child'
-    FLAGS.sample_name_to_train = 'child'
-    FLAGS.sample_name_parent1 = 'parent1'
-    FLAGS.sample_name_parent2 = 'parent2'
-    FLAGS.truth_variants = testdata.TRUTH_VARIANTS_VCF
-    FLAGS.confident_regions = testdata.CONFIDENT_REGIONS_BED
-    FLAGS.mode = 'training'
-    FLAGS.examples = ''
-
-    FLAGS.training_random_emit_ref_sites = 0.3
-    options = make_examples.default_options(add_flags=True)
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options,
+        _trio_flags('training', training_random_emit_ref_sites=0.3))
     self.assertAlmostEqual(
         options.sample_options[1].variant_caller_options
         .fraction_reference_sites_to_emit, 0.3)
 
-  @flagsaver.flagsaver
   def test_default_options_without_training_random_emit_ref_sites(self):
-    FLAGS.ref = testdata.CHR20_FASTA
-    FLAGS.reads = testdata.HG001_CHR20_BAM
-    FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
-    FLAGS.reads_parent2 = testdata.NA12892_CHR20_BAM
-    FLAGS.sample_name = 'child'
-    FLAGS.sample_name_to_train = 'child'
-    FLAGS.sample_name_parent1 = 'parent1'
-    FLAGS.sample_name_parent2 = 'parent2'
-    FLAGS.truth_variants = testdata.TRUTH_VARIANTS_VCF
-    FLAGS.confident_regions = testdata.CONFIDENT_REGIONS_BED
-    FLAGS.mode = 'training'
-    FLAGS.examples = ''
-
-    options = make_examples.default_options(add_flags=True)
+    options = self._clone_base_options()
     # In proto3, there is no way to check presence of scalar field:
     # redacted
     # As an approximation, we directly check that the value should be exactly 0.
@@ -841,22 +953,8 @@ class MakeExamplesUnitTest(parameterized.TestCase):
         options.sample_options[1].variant_caller_options
         .fraction_reference_sites_to_emit, 0.0)
 
-  @flagsaver.flagsaver
   def test_confident_regions(self):
-    FLAGS.ref = testdata.CHR20_FASTA
-    FLAGS.reads = testdata.HG001_CHR20_BAM
-    FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
-    FLAGS.reads_parent2 = testdata.NA12892_CHR20_BAM
-    FLAGS.sample_name = 'child'
-    FLAGS.sample_name_to_train = 'child'
-    FLAGS.sample_name_parent1 = 'parent1'
-    FLAGS.sample_name_parent2 = 'parent2'
-    FLAGS.truth_variants = testdata.TRUTH_VARIANTS_VCF
-    FLAGS.confident_regions = testdata.CONFIDENT_REGIONS_BED
-    FLAGS.mode = 'training'
-    FLAGS.examples = ''
-
-    options = make_examples.default_options(add_flags=True)
+    options = self._clone_base_options()
     confident_regions = make_examples_core.read_confident_regions(options)
 
     # Our expected intervals, inlined from CONFIDENT_REGIONS_BED.
@@ -900,16 +998,12 @@ class MakeExamplesUnitTest(parameterized.TestCase):
           'candidates': ('baz@10', 'baz-00001-of-00010')
       },),
   )
-  @flagsaver.flagsaver
   def test_sharded_outputs1(self, settings):
-    # Set all of the requested flag values.
-    for name, (flag_val, _) in settings.items():
-      setattr(FLAGS, name, flag_val)
-
-    FLAGS.mode = 'training'
-    FLAGS.reads = ''
-    FLAGS.ref = ''
-    options = make_examples.default_options(add_flags=True)
+    # Use all of the requested flag values.
+    overrides = {name: flag_val for name, (flag_val, _) in settings.items()}
+    overrides.update(mode='training', reads='', ref='')
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options, overrides)
 
     # Check all of the flags.
     for name, option_val in [('examples', options.examples_filename),
@@ -931,7 +1025,6 @@ class MakeExamplesUnitTest(parameterized.TestCase):
   @flagsaver.flagsaver
   def test_catches_bad_flags(self):
     # Set all of the requested flag values.
-    region = ranges.parse_literal('20:10,000,000-10,010,000')
     FLAGS.ref = testdata.CHR20_FASTA
     FLAGS.reads = testdata.HG001_CHR20_BAM
     FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
@@ -942,7 +1035,7 @@ class MakeExamplesUnitTest(parameterized.TestCase):
     FLAGS.sample_name_parent2 = 'parent2'
     FLAGS.candidates = test_utils.test_tmpfile('vsc.tfrecord')
     FLAGS.examples = test_utils.test_tmpfile('examples.tfrecord')
-    FLAGS.regions = [ranges.to_literal(region)]
+    FLAGS.regions = [_REGION_10M_10K_LITERAL]
     FLAGS.partition_size = 1000
     FLAGS.mode = 'training'
     FLAGS.truth_variants = testdata.TRUTH_VARIANTS_VCF
@@ -1002,6 +1095,21 @@ class MakeExamplesUnitTest(parameterized.TestCase):
 
 class RegionProcessorTest(parameterized.TestCase):
 
+  # Bases and qualities of a 101bp read, shared by the tests below.
+  _READ_SEQ = 'A' * 101
+  _READ_QUALS = (30,) * 101
+
+  @classmethod
+  def setUpClass(cls):
+    super(RegionProcessorTest, cls).setUpClass()
+    # The reference is only queried, so all tests share one reader.
+    cls._ref_reader = fasta.IndexedFastaReader(testdata.CHR20_FASTA)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls._ref_reader.__exit__(None, None, None)
+    super(RegionProcessorTest, cls).tearDownClass()
+
   def setUp(self):
     super(RegionProcessorTest, self).setUp()
     self.region = ranges.parse_literal('20:10,000,000-10,000,100')
@@ -1012,7 +1120,7 @@ class RegionProcessorTest(parameterized.TestCase):
     self.options.truth_variants_filename = testdata.TRUTH_VARIANTS_VCF
     self.options.mode = deepvariant_pb2.MakeExamplesOptions.TRAINING
 
-    self.ref_reader = fasta.IndexedFastaReader(self.options.reference_filename)
+    self.ref_reader = self._ref_reader
     self.default_shape = [5, 5, 7]
     self.processor = make_examples_core.RegionProcessor(self.options)
     self.mock_init = self.add_mock('_initialize')
@@ -1020,7 +1128,7 @@ class RegionProcessorTest(parameterized.TestCase):
       sample.in_memory_sam_reader = mock.Mock()
 
   def add_mock(self, name, retval='dontadd', side_effect='dontadd'):
-    patcher = mock.patch.object(self.processor, name, autospec=True)
+    patcher = mock.patch.object(self.processor, name)
     self.addCleanup(patcher.stop)
     mocked = patcher.start()
     if retval != 'dontadd':
@@ -1143,23 +1251,14 @@ class RegionProcessorTest(parameterized.TestCase):
                                  six.b('foo'), self.default_shape)
 
   def test_use_original_quality_scores_without_parse_sam_aux_fields(self):
-    FLAGS.mode = 'calling'
-    FLAGS.ref = testdata.CHR20_FASTA
-    FLAGS.reads = testdata.HG001_CHR20_BAM
-    FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
-    FLAGS.reads_parent2 = testdata.NA12892_CHR20_BAM
-    FLAGS.sample_name = 'child'
-    FLAGS.sample_name_to_train = 'child'
-    FLAGS.sample_name_parent1 = 'parent1'
-    FLAGS.sample_name_parent2 = 'parent2'
-    FLAGS.examples = 'examples.tfrecord'
-    FLAGS.use_original_quality_scores = True
-    FLAGS.parse_sam_aux_fields = False
+    overrides = _trio_flags(
+        'calling', use_original_quality_scores=True, parse_sam_aux_fields=False)
 
     with six.assertRaisesRegex(
         self, Exception, 'If --use_original_quality_scores is set then '
         '--parse_sam_aux_fields must be set too.'):
-      make_examples.default_options(add_flags=True)
+      make_examples_options.default_options_from_dict(
+          make_examples.default_options, overrides)
 
   @parameterized.parameters(
       dict(height_parent=10, height_child=9),
@@ -1167,24 +1266,15 @@ class RegionProcessorTest(parameterized.TestCase):
       dict(height_parent=100, height_child=101),
       dict(height_parent=101, height_child=100),
   )
-  @flagsaver.flagsaver
   def test_image_heights(self, height_parent, height_child):
-    FLAGS.pileup_image_height_parent = height_parent
-    FLAGS.pileup_image_height_child = height_child
-    FLAGS.mode = 'calling'
-    FLAGS.ref = testdata.CHR20_FASTA
-    FLAGS.reads = testdata.HG001_CHR20_BAM
-    FLAGS.reads_parent1 = testdata.NA12891_CHR20_BAM
-    FLAGS.reads_parent2 = testdata.NA12892_CHR20_BAM
-    FLAGS.sample_name = 'child'
-    FLAGS.sample_name_to_train = 'child'
-    FLAGS.sample_name_parent1 = 'parent1'
-    FLAGS.sample_name_parent2 = 'parent2'
-    FLAGS.examples = 'examples.tfrecord'
-
-    options = make_examples.default_options(add_flags=True)
-    with self.assertRaisesRegex(
-        Exception, 'Pileup image heights must be between 10 and 100.'):
+    overrides = _trio_flags(
+        'calling',
+        pileup_image_height_parent=height_parent,
+        pileup_image_height_child=height_child)
+
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options, overrides)
+    with self.assertRaisesRegex(Exception, _PILEUP_HEIGHT_RE):
       make_examples.check_options_are_valid(options)
 
   @parameterized.parameters(
@@ -1195,9 +1285,7 @@ class RegionProcessorTest(parameterized.TestCase):
   def test_align_to_all_haplotypes(self, window_width):
     # align_to_all_haplotypes() will pull from the reference, so choose a
     # real variant.
-    region = ranges.parse_literal('20:10,046,000-10,046,400')
-    nist_reader = vcf.VcfReader(testdata.TRUTH_VARIANTS_VCF)
-    nist_variants = list(nist_reader.query(region))
+    nist_variants = _truth_variants('20:10,046,000-10,046,400')
     # We picked this region to have exactly one known variant:
     # reference_bases: "AAGAAAGAAAG"
     # alternate_bases: "A", a deletion of 10 bp
@@ -1205,21 +1293,22 @@ class RegionProcessorTest(parameterized.TestCase):
     # end: 10046188
     # reference_name: "chr20"
 
-    variant = nist_variants[0]
+    # Copy the cached variant, since this test modifies it below.
+    variant = copy.deepcopy(nist_variants[0])
 
-    self.processor.pic = mock.Mock()
-    self.processor.pic.width = window_width
-    self.processor.pic.half_width = int((window_width - 1) / 2)
+    # Only the window size is read from pic.
+    self.processor.pic = types.SimpleNamespace(
+        width=window_width, half_width=(window_width - 1) // 2)
 
-    self.processor.realigner = mock.Mock()
+    self.processor.realigner = mock.Mock(
+        spec=['align_to_haplotype', 'ref_reader'])
     # Using a real ref_reader to test that the reference allele matches
     # between the variant and the reference at the variant's coordinates.
     self.processor.realigner.ref_reader = self.ref_reader
 
     read = test_utils.make_read(
-        'A' * 101, start=10046100, cigar='101M', quals=[30] * 101)
+        self._READ_SEQ, start=10046100, cigar='101M', quals=self._READ_QUALS)
 
-    self.processor.realigner.align_to_haplotype = mock.Mock()
     alt_info = self.processor.align_to_all_haplotypes(variant, [read])
     hap_alignments = alt_info['alt_alignments']
     hap_sequences = alt_info['alt_sequences']
@@ -1236,8 +1325,7 @@ class RegionProcessorTest(parameterized.TestCase):
 
     # If variant reference_bases are wrong, it should raise a ValueError.
     variant.reference_bases = 'G'
-    with six.assertRaisesRegex(self, ValueError,
-                               'does not match the bases in the reference'):
+    with self.assertRaisesRegex(ValueError, _REF_MISMATCH_RE):
       self.processor.align_to_all_haplotypes(variant, [read])
 
 
@@ -29,6 +29,7 @@
 """Tests for deepvariant.make_examples_core."""
 
 import copy
+import functools
 from unittest import mock
 
 
@@ -49,6 +50,7 @@ from third_party.nucleus.util import variant_utils
 from deepvariant import dv_constants
 from deepvariant import make_examples
 from deepvariant import make_examples_core
+from deepvariant import make_examples_options
 from deepvariant import testdata
 from deepvariant import tf_utils
 from deepvariant.labeler import variant_labeler
@@ -86,14 +88,51 @@ def _make_contigs(specs):
     ]
 
 
+@functools.lru_cache(maxsize=None)
+def _parse_literal_cached(literal):
+  """Parses a region literal once; the returned Range is shared, don't modify."""
+  return ranges.parse_literal(literal)
+
+
 def _from_literals_list(literals, contig_map=None):
   """Makes a list of Range objects from literals."""
-  return ranges.parse_literals(literals, contig_map)
+  if contig_map is not None:
+    return ranges.parse_literals(literals, contig_map)
+  return [_parse_literal_cached(literal) for literal in literals]
 
 
 def _from_literals(literals, contig_map=None):
   """Makes a RangeSet of intervals from literals."""
-  return ranges.RangeSet.from_regions(literals, contig_map)
+  if literals is None or contig_map is not None:
+    return ranges.RangeSet.from_regions(literals, contig_map)
+  # RangeSet copies the intervals out, so the cached Ranges stay untouched.
+  return ranges.RangeSet(_from_literals_list(literals))
+
+
+def _range_keys(regions):
+  """Returns (reference_name, start, end) tuples for the Range protos given.
+
+  Tuples hash and compare much faster than protos, so comparing these keeps
+  the interval assertions below cheap even with many regions.
+  """
+  return [(r.reference_name, r.start, r.end) for r in regions]
+
+
+# Contigs shared by the interval tests below. These are built once at import,
+# so tests must not modify them.
+_CONTIGS_1_100_2_200 = _make_contigs([('1', 100), ('2', 200)])
+_CONTIGS_1_100_2_76_3_121 = _make_contigs([('1', 100), ('2', 76), ('3', 121)])
+_CONTIGS_Z_A_N = _make_contigs([('z', 100), ('a', 100), ('n', 100)])
+
+
+@functools.lru_cache(maxsize=None)
+def _truth_variants(region_literal):
+  """Returns the truth variants in region_literal, read once per process.
+
+  Callers must copy a variant before modifying it.
+  """
+  with vcf.VcfReader(testdata.TRUTH_VARIANTS_VCF) as reader:
+    return tuple(reader.query(ranges.parse_literal(region_literal)))
 
 
 class MakeExamplesCoreUnitTest(parameterized.TestCase):
@@ -197,24 +236,28 @@ class MakeExamplesCoreUnitTest(parameterized.TestCase):
     # Our confident regions should be exactly those found in the BED file.
     six.assertCountEqual(self, expected, list(confident_regions))
 
-  @flagsaver.flagsaver
   def test_gvcf_output_enabled_is_false_without_gvcf_flag(self):
-    FLAGS.mode = 'training'
-    FLAGS.gvcf = ''
-    FLAGS.reads = ''
-    FLAGS.ref = ''
-    FLAGS.examples = ''
-    options = make_examples.default_options(add_flags=True)
+    overrides = {
+        'mode': 'training',
+        'gvcf': '',
+        'reads': '',
+        'ref': '',
+        'examples': '',
+    }
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options, overrides)
     self.assertFalse(make_examples_core.gvcf_output_enabled(options))
 
-  @flagsaver.flagsaver
   def test_gvcf_output_enabled_is_true_with_gvcf_flag(self):
-    FLAGS.mode = 'training'
-    FLAGS.gvcf = '/tmp/foo.vcf'
-    FLAGS.reads = ''
-    FLAGS.ref = ''
-    FLAGS.examples = ''
-    options = make_examples.default_options(add_flags=True)
+    overrides = {
+        'mode': 'training',
+        'gvcf': '/tmp/foo.vcf',
+        'reads': '',
+        'ref': '',
+        'examples': '',
+    }
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options, overrides)
     self.assertTrue(make_examples_core.gvcf_output_enabled(options))
 
   def test_validate_ref_contig_coverage(self):
@@ -280,76 +323,91 @@ class MakeExamplesCoreUnitTest(parameterized.TestCase):
       # the intersection code logic itself is good and well-tested elsewhere.
       # Here we are focusing on some basic tests and handling of missing
       # calling_region and confident_region data.
-      (['1:1-10'], ['1:1-10']),
-      (['1:1-100'], ['1:1-100']),
-      (['1:50-150'], ['1:50-100']),
-      (None, ['1:1-100', '2:1-200']),
-      (['1:20-50'], ['1:20-50']),
+      (_from_literals(['1:1-10']), _from_literals_list(['1:1-10'])),
+      (_from_literals(['1:1-100']), _from_literals_list(['1:1-100'])),
+      (_from_literals(['1:50-150']), _from_literals_list(['1:50-100'])),
+      (_from_literals(None), _from_literals_list(['1:1-100', '2:1-200'])),
+      (_from_literals(['1:20-50']), _from_literals_list(['1:20-50'])),
       # Chr3 isn't part of our contigs; make sure we tolerate it.
-      (['1:20-30', '1:40-60', '3:10-50'], ['1:20-30', '1:40-60']),
+      (_from_literals(['1:20-30', '1:40-60', '3:10-50']),
+       _from_literals_list(['1:20-30', '1:40-60'])),
       # Check that we handle overlapping calling or confident regions.
-      (['1:25-30', '1:20-40'], ['1:20-40']),
+      (_from_literals(['1:25-30', '1:20-40']),
+       _from_literals_list(['1:20-40'])),
   )
   def test_regions_to_process(self, calling_regions, expected):
-    contigs = _make_contigs([('1', 100), ('2', 200)])
-    six.assertCountEqual(
-        self, _from_literals_list(expected),
-        make_examples_core.regions_to_process(
-            contigs, 1000, calling_regions=_from_literals(calling_regions)))
+    actual = make_examples_core.regions_to_process(
+        _CONTIGS_1_100_2_200, 1000, calling_regions=calling_regions)
+    self.assertEqual(sorted(_range_keys(expected)), sorted(_range_keys(actual)))
 
   @parameterized.parameters(
-      (50, None, [
-          '1:1-50', '1:51-100', '2:1-50', '2:51-76', '3:1-50', '3:51-100',
-          '3:101-121'
-      ]),
-      (120, None, ['1:1-100', '2:1-76', '3:1-120', '3:121']),
-      (500, None, ['1:1-100', '2:1-76', '3:1-121']),
-      (10, ['1:1-20', '1:30-35'], ['1:1-10', '1:11-20', '1:30-35']),
-      (8, ['1:1-20', '1:30-35'], ['1:1-8', '1:9-16', '1:17-20', '1:30-35']),
+      (50, _from_literals(None),
+       _from_literals_list([
+           '1:1-50', '1:51-100', '2:1-50', '2:51-76', '3:1-50', '3:51-100',
+           '3:101-121'
+       ])),
+      (120, _from_literals(None),
+       _from_literals_list(['1:1-100', '2:1-76', '3:1-120', '3:121'])),
+      (500, _from_literals(None),
+       _from_literals_list(['1:1-100', '2:1-76', '3:1-121'])),
+      (10, _from_literals(['1:1-20', '1:30-35']),
+       _from_literals_list(['1:1-10', '1:11-20', '1:30-35'])),
+      (8, _from_literals(['1:1-20', '1:30-35']),
+       _from_literals_list(['1:1-8', '1:9-16', '1:17-20', '1:30-35'])),
   )
   def test_regions_to_process_partition(self, max_size, calling_regions,
                                         expected):
-    contigs = _make_contigs([('1', 100), ('2', 76), ('3', 121)])
-    six.assertCountEqual(
-        self, _from_literals_list(expected),
-        make_examples_core.regions_to_process(
-            contigs, max_size, calling_regions=_from_literals(calling_regions)))
+    actual = make_examples_core.regions_to_process(
+        _CONTIGS_1_100_2_76_3_121, max_size, calling_regions=calling_regions)
+    self.assertEqual(sorted(_range_keys(expected)), sorted(_range_keys(actual)))
 
   @parameterized.parameters(
-      dict(includes=[], excludes=[], expected=['1:1-100', '2:1-200']),
-      dict(includes=['1'], excludes=[], expected=['1:1-100']),
+      dict(
+          includes=[],
+          excludes=[],
+          expected=_from_literals_list(['1:1-100', '2:1-200'])),
+      dict(
+          includes=['1'], excludes=[],
+          expected=_from_literals_list(['1:1-100'])),
       # Check that excludes work as expected.
-      dict(includes=[], excludes=['1'], expected=['2:1-200']),
-      dict(includes=[], excludes=['2'], expected=['1:1-100']),
-      dict(includes=[], excludes=['1', '2'], expected=[]),
+      dict(
+          includes=[], excludes=['1'],
+          expected=_from_literals_list(['2:1-200'])),
+      dict(
+          includes=[], excludes=['2'],
+          expected=_from_literals_list(['1:1-100'])),
+      dict(includes=[], excludes=['1', '2'], expected=_from_literals_list([])),
       # Check that excluding pieces works. The main checks on taking the
       # difference between two RangeSets live in ranges.py so here we are just
       # making sure some basic logic works.
-      dict(includes=['1'], excludes=['1:1-10'], expected=['1:11-100']),
+      dict(
+          includes=['1'],
+          excludes=['1:1-10'],
+          expected=_from_literals_list(['1:11-100'])),
       # Check that includes and excludes work together.
       dict(
           includes=['1', '2'],
           excludes=['1:5-10', '1:20-50', '2:10-20'],
-          expected=['1:1-4', '1:11-19', '1:51-100', '2:1-9', '2:21-200']),
+          expected=_from_literals_list(
+              ['1:1-4', '1:11-19', '1:51-100', '2:1-9', '2:21-200'])),
       dict(
           includes=['1'],
           excludes=['1:5-10', '1:20-50', '2:10-20'],
-          expected=['1:1-4', '1:11-19', '1:51-100']),
+          expected=_from_literals_list(['1:1-4', '1:11-19', '1:51-100'])),
       dict(
           includes=['2'],
           excludes=['1:5-10', '1:20-50', '2:10-20'],
-          expected=['2:1-9', '2:21-200']),
+          expected=_from_literals_list(['2:1-9', '2:21-200'])),
       # A complex example of including and excluding.
       dict(
           includes=['1:10-20', '2:50-60', '2:70-80'],
           excludes=['1:1-13', '1:19-50', '2:10-65'],
-          expected=['1:14-18', '2:70-80']),
+          expected=_from_literals_list(['1:14-18', '2:70-80'])),
   )
   def test_build_calling_regions(self, includes, excludes, expected):
-    contigs = _make_contigs([('1', 100), ('2', 200)])
-    actual = make_examples_core.build_calling_regions(contigs, includes,
-                                                      excludes)
-    six.assertCountEqual(self, actual, _from_literals_list(expected))
+    actual = make_examples_core.build_calling_regions(_CONTIGS_1_100_2_200,
+                                                      includes, excludes)
+    self.assertEqual(sorted(_range_keys(actual)), sorted(_range_keys(expected)))
 
   def test_regions_to_process_sorted_within_contig(self):
     # These regions are out of order but within a single contig.
@@ -361,18 +419,18 @@ class MakeExamplesCoreUnitTest(parameterized.TestCase):
         make_examples_core.regions_to_process(
             contigs, 100, calling_regions=in_regions))
     # The assertEqual here is checking the order is exactly what we expect.
-    self.assertEqual(sorted_regions, actual_regions)
+    self.assertEqual(_range_keys(sorted_regions), _range_keys(actual_regions))
 
   def test_regions_to_process_sorted_contigs(self):
     # These contig names are out of order lexicographically.
-    contigs = _make_contigs([('z', 100), ('a', 100), ('n', 100)])
+    contigs = _CONTIGS_Z_A_N
     in_regions = _from_literals(['a:10', 'n:1', 'z:20', 'z:5'])
     sorted_regions = _from_literals_list(['z:5', 'z:20', 'a:10', 'n:1'])
     actual_regions = list(
         make_examples_core.regions_to_process(
             contigs, 100, calling_regions=in_regions))
     # The assertEqual here is checking the order is exactly what we expect.
-    self.assertEqual(sorted_regions, actual_regions)
+    self.assertEqual(_range_keys(sorted_regions), _range_keys(actual_regions))
 
   @parameterized.parameters([2, 3, 4, 5, 50])
   def test_regions_to_process_sharding(self, num_shards):
@@ -380,7 +438,7 @@ class MakeExamplesCoreUnitTest(parameterized.TestCase):
 
     def get_regions(task_id, num_shards):
       return make_examples_core.regions_to_process(
-          contigs=_make_contigs([('z', 100), ('a', 100), ('n', 100)]),
+          contigs=_CONTIGS_Z_A_N,
           partition_size=5,
           task_id=task_id,
           num_shards=num_shards)
@@ -391,7 +449,9 @@ class MakeExamplesCoreUnitTest(parameterized.TestCase):
     for task_id in range(num_shards):
       task_regions = get_regions(task_id, num_shards)
       sharded_regions.extend(task_regions)
-    six.assertCountEqual(self, unsharded_regions, sharded_regions)
+    self.assertEqual(
+        sorted(_range_keys(unsharded_regions)),
+        sorted(_range_keys(sharded_regions)))
 
   @parameterized.parameters(
       # Providing one of task id and num_shards but not the other is bad.
@@ -409,7 +469,7 @@ class MakeExamplesCoreUnitTest(parameterized.TestCase):
   def test_regions_to_process_fails_with_bad_shard_args(self, task, num_shards):
     with self.assertRaises(ValueError):
       make_examples_core.regions_to_process(
-          contigs=_make_contigs([('z', 100), ('a', 100), ('n', 100)]),
+          contigs=_CONTIGS_Z_A_N,
           partition_size=10,
           task_id=task,
           num_shards=num_shards)
@@ -563,6 +623,17 @@ class MakeExamplesCoreUnitTest(parameterized.TestCase):
 
 class RegionProcessorTest(parameterized.TestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    super(RegionProcessorTest, cls).setUpClass()
+    # The reference is only queried, so all tests share one reader.
+    cls._ref_reader = fasta.IndexedFastaReader(testdata.CHR20_FASTA)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls._ref_reader.__exit__(None, None, None)
+    super(RegionProcessorTest, cls).tearDownClass()
+
   def setUp(self):
     super(RegionProcessorTest, self).setUp()
     self._saved_flags = flagsaver.save_flag_values()
@@ -579,7 +650,7 @@ class RegionProcessorTest(parameterized.TestCase):
     self.options.truth_variants_filename = testdata.TRUTH_VARIANTS_VCF
     self.options.mode = deepvariant_pb2.MakeExamplesOptions.TRAINING
     self.processor = make_examples_core.RegionProcessor(self.options)
-    self.ref_reader = fasta.IndexedFastaReader(self.options.reference_filename)
+    self.ref_reader = self._ref_reader
     self.mock_init = self.add_mock('initialize')
     for sample in self.processor.samples:
       sample.in_memory_sam_reader = mock.Mock()
@@ -590,7 +661,7 @@ class RegionProcessorTest(parameterized.TestCase):
     flagsaver.restore_flag_values(self._saved_flags)
 
   def add_mock(self, name, retval='dontadd', side_effect='dontadd'):
-    patcher = mock.patch.object(self.processor, name, autospec=True)
+    patcher = mock.patch.object(self.processor, name)
     self.addCleanup(patcher.stop)
     mocked = patcher.start()
     if retval != 'dontadd':
@@ -966,9 +1037,7 @@ class RegionProcessorTest(parameterized.TestCase):
   def test_align_to_all_haplotypes(self, window_width):
     # align_to_all_haplotypes() will pull from the reference, so choose a
     # real variant.
-    region = ranges.parse_literal('chr20:10,046,000-10,046,400')
-    nist_reader = vcf.VcfReader(testdata.TRUTH_VARIANTS_VCF)
-    nist_variants = list(nist_reader.query(region))
+    nist_variants = _truth_variants('chr20:10,046,000-10,046,400')
     # We picked this region to have exactly one known variant:
     # reference_bases: "AAGAAAGAAAG"
     # alternate_bases: "A", a deletion of 10 bp
@@ -976,7 +1045,8 @@ class RegionProcessorTest(parameterized.TestCase):
     # end: 10046188
     # reference_name: "chr20"
 
-    variant = nist_variants[0]
+    # Copy the cached variant, since this test modifies it below.
+    variant = copy.deepcopy(nist_variants[0])
 
     self.processor.pic = mock.Mock()
     self.processor.pic.width = window_width
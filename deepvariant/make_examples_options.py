@@ -317,6 +317,67 @@ flags.DEFINE_integer(
     'This flag is used only when phase_reads is true.')
 
 
+class _FlagValue(object):
+  """Minimal stand-in for an absl Flag, exposing only `value`."""
+
+  def __init__(self, value):
+    self.value = value
+
+
+class FlagOverrides(object):
+  """Read-only view of a FlagValues object with some values overridden.
+
+  Can be passed as `flags_obj` to default_options() so that callers (mostly
+  tests) can build options from a dict without mutating the global FLAGS.
+  Both attribute access (`flags_obj.mode`) and item access
+  (`flags_obj['mode'].value`) are supported.
+  """
+
+  def __init__(self, overrides, flags_obj=None):
+    self._flags_obj = flags_obj if flags_obj is not None else FLAGS
+    for name in overrides:
+      if name not in self._flags_obj:
+        raise ValueError('Unknown flag: {}'.format(name))
+    self._overrides = dict(overrides)
+
+  def __getattr__(self, name):
+    # Only called for names missing from the instance. Flags are never
+    # private, and looking up self._overrides before __init__ has set it (as
+    # copy and pickle do) would otherwise recurse forever.
+    if name.startswith('_'):
+      raise AttributeError(name)
+    if name in self._overrides:
+      return self._overrides[name]
+    return getattr(self._flags_obj, name)
+
+  def __getitem__(self, name):
+    if name in self._overrides:
+      return _FlagValue(self._overrides[name])
+    return self._flags_obj[name]
+
+
+def default_options_from_dict(default_options_fn, overrides):
+  """Creates a MakeExamplesOptions proto from a dict of flag values.
+
+  Flags not present in `overrides` keep their current FLAGS value. Unlike
+  setting FLAGS directly, this does not modify any global state.
+
+  Args:
+    default_options_fn: The default_options function of the calling
+      make_examples module, e.g. deepvariant.make_examples.default_options.
+    overrides: dict. Maps flag names to the values to use instead of FLAGS.
+
+  Returns:
+    deepvariant_pb2.MakeExamplesOptions protobuf.
+
+  Raises:
+    ValueError: If `overrides` names an unknown flag, or if we observe invalid
+      flag values.
+  """
+  return default_options_fn(
+      add_flags=True, flags_obj=FlagOverrides(overrides))
+
+
 def shared_flags_to_options(
     add_flags, flags_obj, samples_in_order, sample_role_to_train,
     main_sample_index) -> deepvariant_pb2.MakeExamplesOptions:
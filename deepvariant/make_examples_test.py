@@ -28,6 +28,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 """Tests for deepvariant.make_examples."""
 
+import copy
 import enum
 import errno
 import json
@@ -48,6 +49,7 @@ import six
 from deepvariant import dv_constants
 from deepvariant import make_examples
 from deepvariant import make_examples_core
+from deepvariant import make_examples_options
 from deepvariant import testdata
 from deepvariant import tf_utils
 from deepvariant.protos import deepvariant_pb2
@@ -949,16 +951,12 @@ class DefaultOptionsTest(parameterized.TestCase):
           'candidates': ('baz@10', 'baz-00001-of-00010')
       },),
   )
-  @flagsaver.flagsaver
   def test_sharded_outputs1(self, settings):
-    # Set all of the requested flag values.
-    for name, (flag_val, _) in settings.items():
-      setattr(FLAGS, name, flag_val)
-
-    FLAGS.mode = 'training'
-    FLAGS.reads = ''
-    FLAGS.ref = ''
-    options = make_examples.default_options(add_flags=True)
+    # Use all of the requested flag values.
+    overrides = {name: flag_val for name, (flag_val, _) in settings.items()}
+    overrides.update(mode='training', reads='', ref='')
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options, overrides)
 
     # Check all of the flags.
     for name, option_val in [('examples', options.examples_filename),
@@ -967,6 +965,55 @@ class DefaultOptionsTest(parameterized.TestCase):
       expected = settings[name][1] if name in settings else ''
       self.assertEqual(expected, option_val)
 
+  def test_flag_overrides(self):
+    overrides = make_examples_options.FlagOverrides({
+        'mode': 'training',
+        'parse_sam_aux_fields': True,
+    })
+    # Overridden flags are visible through both attribute and item access.
+    self.assertEqual(overrides.mode, 'training')
+    self.assertEqual(overrides['mode'].value, 'training')
+    self.assertTrue(overrides['parse_sam_aux_fields'].value)
+    # Other flags fall through to FLAGS.
+    self.assertEqual(overrides.partition_size, FLAGS.partition_size)
+    self.assertEqual(overrides['partition_size'].value, FLAGS.partition_size)
+    # Copies are built without calling __init__, which must not recurse.
+    self.assertEqual(copy.copy(overrides).mode, 'training')
+
+  def test_flag_overrides_rejects_unknown_flag(self):
+    with self.assertRaisesRegex(ValueError, 'Unknown flag: not_a_flag'):
+      make_examples_options.default_options_from_dict(
+          make_examples.default_options, {'not_a_flag': 1})
+
+  def test_default_options_from_dict_does_not_modify_flags(self):
+    original_mode = FLAGS.mode
+    overrides = {
+        'mode': 'training',
+        'reads': '',
+        'ref': '',
+        'examples': 'foo.tfrecord',
+    }
+    options = make_examples_options.default_options_from_dict(
+        make_examples.default_options, overrides)
+    self.assertEqual(options.examples_filename, 'foo.tfrecord')
+    self.assertEqual(FLAGS.mode, original_mode)
+
+  def test_default_options_from_dict_checks_sam_aux_fields(self):
+    # resolve_sam_aux_fields reads flags as flags_obj[name].value.
+    overrides = {
+        'mode': 'training',
+        'reads': '',
+        'ref': '',
+        'examples': '',
+        'use_original_quality_scores': True,
+        'parse_sam_aux_fields': False,
+    }
+    with self.assertRaisesRegex(
+        Exception, 'If --use_original_quality_scores is set then '
+        '--parse_sam_aux_fields must be set too.'):
+      make_examples_options.default_options_from_dict(
+          make_examples.default_options, overrides)
+
   @flagsaver.flagsaver
   def test_add_supporting_other_alt_color(self):
     FLAGS.mode = 'training'